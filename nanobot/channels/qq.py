@@ -3,10 +3,13 @@
 import asyncio
 import os
 import re
-import subprocess
-from collections import deque
+import signal
+from collections import OrderedDict
+from contextlib import aclosing
 from pathlib import Path
 from typing import TYPE_CHECKING
+from urllib.parse import quote
+from uuid import uuid4
 
 import httpx
 from loguru import logger
@@ -59,16 +62,27 @@ class QQChannel(BaseChannel):
         super().__init__(config, bus)
         self.config: QQConfig = config
         self._client: "botpy.Client | None" = None
-        self._processed_ids: deque = deque(maxlen=1000)
-        self._reply_seq: dict[str, int] = {}  # msg_id -> last msg_seq used
-
-    _IMAGE_EXTS = {".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp"}
+        self._processed_ids: OrderedDict[str, None] = OrderedDict()  # Ordered dedup cache
+        self._reply_seq: OrderedDict[str, int] = OrderedDict()  # msg_id -> last msg_seq used (LRU)
+        self._http: httpx.AsyncClient | None = None
+        self._media_dir = Path.home() / ".nanobot" / "media"
+        self._out_queues: dict[str, asyncio.Queue] = {}  # openid -> pending outbound messages
+        self._out_tasks: dict[str, asyncio.Task] = {}  # openid -> sender task
+
+    # QQ file_type: 1=png/jpg, 2=mp4, 3=silk, 4=file(not generally开放)
+    _EXT_TO_FILETYPE = {
+        ".png": 1, ".jpg": 1, ".jpeg": 1, ".gif": 1, ".bmp": 1, ".webp": 1,
+        ".mp4": 2,
+        ".silk": 3,
+    }
     _URL_RE = re.compile(r"https?://[^\s\"'<>]+")
+    _OUT_QUEUE_SIZE = 256
+    _SENDER_IDLE_S = 300.0
+    _DRAIN_TIMEOUT_S = 10.0
 
     @staticmethod
     def _is_url(value: str) -> bool:
-        v = (value or "").strip().lower()
-        return v.startswith("http://") or v.startswith("https://")
+        return (value or "").strip().lower().startswith(("http://", "https://"))
 
     def _next_msg_seq(self, reply_to_msg_id: str | None) -> int | None:
         """Return next msg_seq for a reply chain; None when not replying."""
@@ -77,9 +91,74 @@ class QQChannel(BaseChannel):
         last = int(self._reply_seq.get(reply_to_msg_id, 0) or 0)
         nxt = last + 1
         self._reply_seq[reply_to_msg_id] = nxt
+        self._reply_seq.move_to_end(reply_to_msg_id)
+        while len(self._reply_seq) > 4096:
+            self._reply_seq.popitem(last=False)
         return nxt
 
-    def _upload_to_public_url_sync(self, file_path: str) -> str | None:
+    @staticmethod
+    async def _iter_file(file_path: str, chunk_size: int = 65536):
+        """Yield a file's bytes in chunks, reading off the event loop."""
+        f = await asyncio.to_thread(open, file_path, "rb")
+        try:
+            while chunk := await asyncio.to_thread(f.read, chunk_size):
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+    async def _put_to_public_url(self, file_path: str) -> str | None:
+        """
+        Upload a local file with HTTP PUT to the configured (presigned) URL template.
+
+        The public URL comes from media_upload_public_url if set, then the response
+        Location header, then the PUT URL without its query string.
+        """
+        put_tpl = (self.config.media_upload_put_url or "").strip()
+        if not put_tpl or not self._http:
+            return None
+        timeout_s = max(1, int(getattr(self.config, "media_upload_timeout_s", 60) or 60))
+        # Unique per upload: concurrent sends of e.g. "chart.png" must not overwrite each other.
+        filename = f"{uuid4().hex}_{quote(os.path.basename(file_path))}"
+        put_url = put_tpl.replace("{filename}", filename)
+        try:
+            size = await asyncio.to_thread(os.path.getsize, file_path)
+            async with aclosing(self._iter_file(file_path)) as body:
+                resp = await self._http.put(
+                    put_url,
+                    content=body,
+                    headers={"Content-Length": str(size)},
+                    timeout=timeout_s,
+                )
+        except Exception as e:
+            logger.warning("QQ media_upload_put_url failed: {}", e)
+            return None
+        if not resp.is_success:
+            logger.warning("QQ media_upload_put_url returned HTTP {}", resp.status_code)
+            return None
+        public_tpl = (self.config.media_upload_public_url or "").strip()
+        if public_tpl:
+            return public_tpl.replace("{filename}", filename)
+        location = resp.headers.get("location")
+        if location and self._is_url(location):
+            return location
+        return put_url.split("?", 1)[0]
+
+    @staticmethod
+    async def _kill_process_group(proc: asyncio.subprocess.Process) -> None:
+        """Kill a shell process and its children, waiting only briefly for it to exit."""
+        try:
+            if hasattr(os, "killpg"):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+        except OSError:
+            pass
+        try:
+            await asyncio.wait_for(proc.wait(), timeout=2.0)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _upload_to_public_url(self, file_path: str) -> str | None:
         """
         Convert a local file path to a public URL using a user-provided command.
 
@@ -95,45 +174,86 @@ class QQChannel(BaseChannel):
         else:
             cmdline = f"{cmd} \"{file_path}\""
         try:
-            cp = subprocess.run(
+            proc = await asyncio.create_subprocess_shell(
                 cmdline,
-                shell=True,
-                capture_output=True,
-                text=True,
-                timeout=timeout_s,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                # Own process group, so the uploader the shell spawns can be killed with it.
+                start_new_session=True,
             )
+            finished = False
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout_s)
+                finished = True
+            except asyncio.TimeoutError:
+                logger.warning("QQ media_upload_command timed out after {}s", timeout_s)
+                return None
+            finally:
+                # Also reached on cancellation: never leave the upload process orphaned.
+                if not finished:
+                    await self._kill_process_group(proc)
         except Exception as e:
             logger.warning("QQ media_upload_command failed: {}", e)
             return None
-        out = (cp.stdout or "") + "\n" + (cp.stderr or "")
-        m = self._URL_RE.search(out)
-        if not m:
-            logger.warning("QQ media_upload_command returned no URL (exit={}): {}", cp.returncode, out[:200])
-            return None
-        return m.group(0)
+        # The URL is normally on the last lines: scan the tail first, then the full output,
+        # stdout before stderr, and take the last URL found.
+        for raw in (stdout, stderr):
+            urls = self._URL_RE.findall(raw[-4096:].decode("utf-8", errors="replace"))
+            if not urls and len(raw) > 4096:
+                urls = self._URL_RE.findall(raw.decode("utf-8", errors="replace"))
+            if urls:
+                return urls[-1]
+        # Only the output excerpt is costly, but opt(lazy=True) calls every argument,
+        # so the return code has to be wrapped as well.
+        logger.opt(lazy=True).warning(
+            "QQ media_upload_command returned no URL (exit={}): {}",
+            lambda: proc.returncode,
+            lambda: (stdout or stderr)[:200].decode("utf-8", errors="replace"),
+        )
+        return None
 
     async def _download_attachment(self, url: str, filename_hint: str | None, message_id: str, idx: int) -> str | None:
         """Download an attachment URL to ~/.nanobot/media and return local path."""
         if not url:
             return None
-        media_dir = Path.home() / ".nanobot" / "media"
-        media_dir.mkdir(parents=True, exist_ok=True)
         ext = ""
         if isinstance(filename_hint, str) and filename_hint.strip():
             ext = Path(filename_hint.strip()).suffix
         if not ext:
             ext = ".bin"
         safe_mid = (message_id or "msg")[:16]
-        file_path = media_dir / f"qq_{safe_mid}_{idx}{ext}"
+        file_path = self._media_dir / f"qq_{safe_mid}_{idx}{ext}"
+        if not self._http:
+            return None
+        f = None
+        done = False
         try:
-            async with httpx.AsyncClient(timeout=30.0, follow_redirects=True) as client:
-                resp = await client.get(url)
+            # Stream to disk so large attachments (video) are never fully buffered in memory.
+            async with self._http.stream("GET", url) as resp:
                 if not resp.is_success:
                     return None
-                file_path.write_bytes(resp.content)
+                f = await asyncio.to_thread(open, file_path, "wb")
+                async for chunk in resp.aiter_bytes(chunk_size=65536):
+                    await asyncio.to_thread(f.write, chunk)
+            done = True
             return str(file_path)
         except Exception:
             return None
+        finally:
+            # Runs on cancellation too, so no truncated file is left behind.
+            if f is not None:
+                await asyncio.to_thread(self._finish_download, f, file_path, done)
+
+    @staticmethod
+    def _finish_download(f, file_path: Path, keep: bool) -> None:
+        """Close a download handle and remove the file unless it completed."""
+        try:
+            f.close()
+        except OSError:
+            file_path.unlink(missing_ok=True)
+            raise
+        if not keep:
+            file_path.unlink(missing_ok=True)
 
     async def start(self) -> None:
         """Start the QQ bot."""
@@ -146,6 +266,14 @@ class QQChannel(BaseChannel):
             return
 
         self._running = True
+        self._media_dir.mkdir(parents=True, exist_ok=True)
+        # Attachments mostly come from a single CDN origin; HTTP/2 multiplexes them on one connection.
+        self._http = httpx.AsyncClient(
+            timeout=30.0,
+            follow_redirects=True,
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=8, keepalive_expiry=30.0),
+        )
         BotClass = _make_bot_class(self)
         self._client = BotClass()
 
@@ -166,19 +294,82 @@ class QQChannel(BaseChannel):
     async def stop(self) -> None:
         """Stop the QQ bot."""
         self._running = False
+        await self._drain_outbound()
         if self._client:
             try:
                 await self._client.close()
             except Exception:
                 pass
+        if self._http:
+            await self._http.aclose()
+            self._http = None
         logger.info("QQ bot stopped")
 
     async def send(self, msg: OutboundMessage) -> None:
-        """Send a message through QQ."""
+        """Queue a message for the per-openid sender task (FIFO per user, bounded)."""
         if not self._client:
             logger.warning("QQ client not initialized")
             return
-        if not (msg.content and str(msg.content).strip()) and not (msg.media and len(msg.media) > 0):
+        if not self._running:
+            logger.warning("QQ channel stopped; dropping message for {}", msg.chat_id)
+            return
+        queue = self._out_queues.get(msg.chat_id)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self._OUT_QUEUE_SIZE)
+            self._out_queues[msg.chat_id] = queue
+            self._out_tasks[msg.chat_id] = asyncio.create_task(self._sender_loop(msg.chat_id, queue))
+        try:
+            # Never wait here: the ChannelManager dispatcher serves every channel.
+            queue.put_nowait(msg)
+        except asyncio.QueueFull:
+            logger.warning("QQ outbound queue full for {}; dropping message", msg.chat_id)
+
+    async def _sender_loop(self, openid: str, queue: asyncio.Queue) -> None:
+        """Deliver queued messages for one openid in order; exit once idle."""
+        try:
+            while True:
+                try:
+                    msg = await asyncio.wait_for(queue.get(), timeout=self._SENDER_IDLE_S)
+                except asyncio.TimeoutError:
+                    if queue.empty():
+                        break
+                    continue
+                try:
+                    await self._deliver(msg)
+                finally:
+                    queue.task_done()
+        finally:
+            if self._out_queues.get(openid) is queue:
+                del self._out_queues[openid]
+                self._out_tasks.pop(openid, None)
+
+    async def _drain_outbound(self) -> None:
+        """Give queued outbound messages a bounded time to go out, then cancel sender tasks."""
+        queues = list(self._out_queues.values())
+        if queues:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*(q.join() for q in queues)), timeout=self._DRAIN_TIMEOUT_S
+                )
+            except asyncio.TimeoutError:
+                dropped = sum(q.qsize() for q in queues)
+                logger.warning(
+                    "QQ outbound drain timed out after {}s; dropping {} queued message(s) "
+                    "and cancelling in-flight sends", self._DRAIN_TIMEOUT_S, dropped,
+                )
+        tasks = list(self._out_tasks.values())
+        for task in tasks:
+            task.cancel()
+        # Let cancelled sends finish their cleanup before the clients are closed.
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._out_tasks.clear()
+        self._out_queues.clear()
+
+    async def _deliver(self, msg: OutboundMessage) -> None:
+        """Send a message through QQ."""
+        content_str = (str(msg.content) if msg.content else "").strip()
+        media_list = msg.media or ()
+        if not content_str and not media_list:
             return
 
         meta = msg.metadata or {}
@@ -191,16 +382,23 @@ class QQChannel(BaseChannel):
             msg_seq = self._next_msg_seq(reply_to_msg_id)
 
             async def _send_text(text: str) -> None:
+                """Send already-stripped text."""
                 nonlocal msg_seq
-                t = (text or "").strip()
-                if not t:
+                if not text:
                     return
-                kwargs = {"openid": msg.chat_id, "msg_type": 0, "content": t}
+                kwargs = {"openid": msg.chat_id, "msg_type": 0, "content": text}
                 if reply_to_msg_id and msg_seq is not None:
                     kwargs.update(msg_id=reply_to_msg_id, msg_seq=msg_seq)
                     msg_seq += 1
                 await self._client.api.post_c2c_message(**kwargs)
 
+            # Media failure notices are collected and merged into one text message.
+            notices: list[str] = []
+
+            def _add_notice(text: str) -> None:
+                if text not in notices:
+                    notices.append(text)
+
             async def _send_media_path(path: str) -> None:
                 nonlocal msg_seq
                 p = (path or "").strip()
@@ -208,42 +406,42 @@ class QQChannel(BaseChannel):
                     return
 
                 # If already a public URL, use it directly; otherwise try upload command.
+                # If the input was already a URL, we can only best-effort treat it as an image.
+                file_type = 1
                 url = p if self._is_url(p) else None
                 if url is None:
                     if not os.path.isfile(p):
                         return
-                    ext = Path(p).suffix.lower()
-                    # QQ file_type: 1=png/jpg, 2=mp4, 3=silk, 4=file(not generally开放)
-                    if ext in self._IMAGE_EXTS:
-                        file_type = 1
-                    elif ext == ".mp4":
-                        file_type = 2
-                    elif ext == ".silk":
-                        file_type = 3
-                    else:
-                        await _send_text("（QQ 附件发送受限：当前文件类型无法直接发送。QQ 官方富媒体接口主要支持图片/视频/语音，并要求公网 URL。建议把文件转成图片/视频，或实现上传并发送链接。）")
+                    file_type = self._EXT_TO_FILETYPE.get(os.path.splitext(p)[1].lower())
+                    if file_type is None:
+                        _add_notice("（QQ 附件发送受限：当前文件类型无法直接发送。QQ 官方富媒体接口主要支持图片/视频/语音，并要求公网 URL。建议把文件转成图片/视频，或实现上传并发送链接。）")
                         return
-                    url = await asyncio.to_thread(self._upload_to_public_url_sync, p)
+                    url = await self._put_to_public_url(p) or await self._upload_to_public_url(p)
                 if not url:
-                    await _send_text("（QQ 附件发送失败：QQ 官方接口要求公网可访问的 URL。请配置 channels.qq.mediaUploadCommand 让它把本地文件上传并输出 URL。）")
+                    _add_notice("（QQ 附件发送失败：QQ 官方接口要求公网可访问的 URL。请配置 channels.qq.mediaUploadPutUrl（HTTP PUT 上传）或 channels.qq.mediaUploadCommand 让它把本地文件上传并输出 URL。）")
                     return
 
                 # Upload-to-QQ to get file_info, then send as media message.
-                # If the input was already a URL, we can only best-effort treat it as an image.
-                ft = locals().get("file_type", 1)
-                media = await self._client.api.post_c2c_file(openid=msg.chat_id, file_type=ft, url=url, srv_send_msg=False)
+                media = await self._client.api.post_c2c_file(openid=msg.chat_id, file_type=file_type, url=url, srv_send_msg=False)
                 kwargs = {"openid": msg.chat_id, "msg_type": 7, "media": media}
                 if reply_to_msg_id and msg_seq is not None:
                     kwargs.update(msg_id=reply_to_msg_id, msg_seq=msg_seq)
                     msg_seq += 1
                 await self._client.api.post_c2c_message(**kwargs)
 
-            # Media first, then text (closer to Telegram behavior)
-            for p in (msg.media or []):
-                await _send_media_path(p)
-
-            if msg.content and str(msg.content).strip():
-                await _send_text(str(msg.content))
+            # Media first, then one combined text (closer to Telegram behavior).
+            if reply_to_msg_id:
+                # msg_seq must increase per msg_id, so replies are sent in order.
+                for p in media_list:
+                    await _send_media_path(p)
+            else:
+                # Without a reply chain the media API calls are independent; send them concurrently.
+                results = await asyncio.gather(*(_send_media_path(p) for p in media_list), return_exceptions=True)
+                for result in results:
+                    if isinstance(result, Exception):
+                        logger.error("Error sending QQ message: {}", result)
+
+            await _send_text("\n\n".join(t for t in (content_str, *notices) if t))
         except Exception as e:
             logger.error("Error sending QQ message: {}", e)
 
@@ -253,7 +451,9 @@ class QQChannel(BaseChannel):
             # Dedup by message ID
             if data.id in self._processed_ids:
                 return
-            self._processed_ids.append(data.id)
+            self._processed_ids[data.id] = None
+            while len(self._processed_ids) > 1000:
+                self._processed_ids.popitem(last=False)
 
             author = data.author
             user_id = str(getattr(author, 'id', None) or getattr(author, 'user_openid', 'unknown'))
@@ -263,20 +463,21 @@ class QQChannel(BaseChannel):
                 content_parts.append(content)
 
             media_paths: list[str] = []
-            attachments = getattr(data, "attachments", None)
-            if isinstance(attachments, list) and attachments:
+            attachments = getattr(data, "attachments", None) or ()
+            if attachments:
+                # Downloads are independent; run them concurrently and keep attachment order.
+                coros = []
                 for i, att in enumerate(attachments):
-                    try:
-                        url = getattr(att, "url", None)
-                        filename = getattr(att, "filename", None)
-                        if isinstance(url, str) and url.strip():
-                            fp = await self._download_attachment(url.strip(), filename if isinstance(filename, str) else None, data.id, i)
-                            if fp:
-                                media_paths.append(fp)
-                                content_parts.append(f"[attachment: {Path(fp).name}]")
-                            else:
-                                content_parts.append("[attachment: download failed]")
-                    except Exception:
+                    url = getattr(att, "url", None)
+                    filename = getattr(att, "filename", None)
+                    if isinstance(url, str) and url.strip():
+                        coros.append(self._download_attachment(url.strip(), filename if isinstance(filename, str) else None, data.id, i))
+                results = await asyncio.gather(*coros, return_exceptions=True)
+                for fp in results:
+                    if isinstance(fp, str) and fp:
+                        media_paths.append(fp)
+                        content_parts.append(f"[attachment: {Path(fp).name}]")
+                    else:
                         content_parts.append("[attachment: download failed]")
 
             if not content_parts and not media_paths:
@@ -288,7 +489,7 @@ class QQChannel(BaseChannel):
                 chat_id=user_id,
                 content=content_out,
                 media=media_paths,
-                metadata={"message_id": data.id, "attachment_count": len(getattr(data, "attachments", []) or [])},
+                metadata={"message_id": data.id, "attachment_count": len(attachments)},
             )
         except Exception:
             logger.exception("Error handling QQ message")
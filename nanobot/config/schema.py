@@ -165,6 +165,8 @@ class QQConfig(Base):
     allow_from: list[str] = Field(default_factory=list)  # Allowed user openids (empty = public access)
     media_upload_command: str = ""  # Optional: command that prints a public URL for a local file. Supports "{path}" placeholder.
     media_upload_timeout_s: int = 60
+    media_upload_put_url: str = ""  # Optional: presigned HTTP PUT URL template with "{filename}"; preferred over media_upload_command.
+    media_upload_public_url: str = ""  # Optional: public URL template with "{filename}" for files uploaded via media_upload_put_url.
 
 
 class ChannelsConfig(Base):